@@ -1,6 +1,10 @@
+import numpy as np
 import pandas as pd
+import errno
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # ========== CONFIGURAÇÃO ==========
 # Defina quantas imagens você quer copiar (None = todas, ou um número como 100, 500, etc.)
@@ -13,6 +17,16 @@ MODO_SELECAO = 'random'  # ou 'first'
 
 # Semente para reproduzir seleção aleatória (opcional, None = aleatório a cada execução)
 RANDOM_SEED = 42  # ou None
+
+# Número de threads usadas na cópia (operação limitada por I/O)
+NUM_WORKERS = 16
+
+# Cria hardlinks em vez de copiar os bytes (cai para cópia se origem e destino
+# estiverem em sistemas de arquivos diferentes)
+USAR_HARDLINK = True
+
+# Linhas do CSV lidas por vez (limita o pico de memória em CSVs grandes)
+CSV_CHUNKSIZE = 50_000
 # ==================================
 
 # Caminhos reais
@@ -20,22 +34,89 @@ read_path = '/home/lapis/Documents/IC/fase_4/Test/chexpert-ssim-classificacao-ma
 csv_path = '/home/lapis/Documents/IC/fase_4/Test/chexpert-ssim-classificacao-main/train.csv'
 dest_path = '/home/lapis/Documents/IC/fase_4/Test/chexpert-ssim-classificacao-main/valid_desconhecidos_frontal'
 
+
+def listar_disponiveis(base, subdirs):
+    """Lista uma única vez cada subdiretório e retorna os arquivos existentes (relativos a base)."""
+    disponiveis = set()
+    for subdir in subdirs:
+        try:
+            with os.scandir(os.path.join(base, subdir)) as it:
+                disponiveis.update(f"{subdir}/{entry.name}" for entry in it if entry.is_file())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return disponiveis
+
+
+# Erros de os.link que indicam que o hardlink não é possível aqui (e não um problema do arquivo)
+ERRNOS_SEM_HARDLINK = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def copiar_arquivo(src, dst):
+    """
+    Cria um hardlink de src em dst; copia o conteúdo quando o link não é possível.
+
+    O resultado é montado com um nome temporário na pasta de destino e movido para
+    dst com os.replace, então nada é escrito através de um dst já existente (que pode
+    ser um hardlink de uma imagem original do dataset). A cópia usa shutil.copyfile,
+    que copia só o conteúdo (sem stat+chmod) e no Linux usa os.sendfile no kernel.
+    """
+    if USAR_HARDLINK:
+        # Já é um link da própria origem (execução anterior): nada a fazer
+        try:
+            if os.path.samefile(src, dst):
+                return
+        except FileNotFoundError:
+            pass
+
+    tmp = os.path.join(
+        os.path.dirname(dst), f".{os.path.basename(dst)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    )
+    try:
+        os.remove(tmp)  # sobra de uma execução interrompida
+    except FileNotFoundError:
+        pass
+
+    try:
+        if USAR_HARDLINK:
+            try:
+                os.link(src, tmp)
+            except OSError as e:
+                if e.errno not in ERRNOS_SEM_HARDLINK:
+                    raise
+                shutil.copyfile(src, tmp)  # dispositivos diferentes ou sem suporte a hardlink
+        else:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 # Cria a pasta de destino se não existir
 os.makedirs(dest_path, exist_ok=True)
 
-# Lê o CSV
-df = pd.read_csv(csv_path)
-
-# Filtra apenas imagens Frontal com "No Finding" desconhecido (NaN ou -1)
-df_filtrado = df[
-    (df['Frontal/Lateral'] == 'Frontal') &
-    (df['No Finding'].isnull() | (df['No Finding'] == -1) | (df['No Finding'] == ''))
-].copy()
+# Lê o CSV em blocos (apenas as colunas usadas, já com tipos definidos) e
+# filtra cada bloco: apenas imagens Frontal com "No Finding" desconhecido (NaN ou -1)
+blocos = pd.read_csv(
+    csv_path,
+    usecols=['Path', 'Frontal/Lateral', 'No Finding'],
+    dtype={'Path': 'string', 'Frontal/Lateral': 'category', 'No Finding': 'float32'},
+    engine='c',
+    chunksize=CSV_CHUNKSIZE,
+)
+selecionados = []
+for bloco in blocos:
+    no_finding = bloco['No Finding'].to_numpy()
+    frontal = (bloco['Frontal/Lateral'] == 'Frontal').to_numpy()
+    desconhecido = np.isnan(no_finding) | (no_finding == -1)
+    selecionados.append(bloco.loc[frontal & desconhecido, ['Path']])
+df_filtrado = pd.concat(selecionados, ignore_index=True)
 
 # Corrige o caminho para remover prefixo incorreto
-df_filtrado['Path'] = df_filtrado['Path'].str.replace(
-    r'^CheXpert-v1\.0/train/', '', regex=True
-)
+df_filtrado['Path'] = df_filtrado['Path'].str.removeprefix('CheXpert-v1.0/train/')
 
 total_encontrado = len(df_filtrado)
 print(f"Total de imagens frontais com 'No Finding' desconhecido/incerto: {total_encontrado}")
@@ -54,29 +135,56 @@ else:
     print(f"Copiando todas as {total_encontrado} imagens encontradas")
 
 # Copia as imagens filtradas
-copied = 0
-missing = 0
-for _, row in df_filtrado.iterrows():
-    relative_path = row['Path']
-    src = os.path.join(read_path, relative_path)  # caminho absoluto correto
-
-    # Extrai nome do paciente
-    parts = relative_path.split('/')
-    paciente = next((p for p in parts if p.startswith('patient')), None)
-
-    if paciente is None:
-        print(f"Paciente não encontrado no caminho: {relative_path}")
-        continue
-
-    filename = os.path.basename(relative_path)
-    new_filename = f"{paciente}_{filename}"
-    dst = os.path.join(dest_path, new_filename)
-
-    if os.path.exists(src):
-        shutil.copy(src, dst)
-        copied += 1
-    else:
-        print(f"Arquivo não encontrado: {src}")
-        missing += 1
+caminhos = df_filtrado['Path']
 
-print(f"\n✅ Cópia concluída: {copied} copiadas, {missing} não encontradas (de {len(df_filtrado)} selecionadas)")
+# Extrai diretório, paciente e nome do arquivo em uma única passada de regex
+partes = caminhos.str.extract(
+    r'^(?P<diretorio>(?:[^/]*/)*?(?P<paciente>patient[^/]*)(?:/[^/]+)*)/(?P<arquivo>[^/]+)$'
+)
+sem_paciente = partes['paciente'].isna()
+for relative_path in caminhos[sem_paciente]:
+    print(f"Paciente não encontrado no caminho: {relative_path}")
+
+caminhos = caminhos[~sem_paciente]
+partes = partes[~sem_paciente]
+
+# Verifica existência com uma listagem por diretório em vez de um stat por arquivo
+disponiveis = listar_disponiveis(read_path, partes['diretorio'].unique())
+existe = caminhos.isin(disponiveis)
+for relative_path in caminhos[~existe]:
+    print(f"Arquivo não encontrado: {os.path.join(read_path, relative_path)}")
+missing = int((~existe).sum())
+
+caminhos = caminhos[existe]
+partes = partes[existe]
+
+# Estudos diferentes do mesmo paciente podem gerar o mesmo destino <paciente>_<arquivo>;
+# como na cópia sequencial, vale a última linha do CSV (entre as que existem), e duas
+# threads nunca escrevem no mesmo arquivo
+nomes = partes['paciente'] + '_' + partes['arquivo']
+ultimos = ~nomes.duplicated(keep='last')
+caminhos = caminhos[ultimos]
+nomes = nomes[ultimos]
+
+src_paths = (read_path + os.sep + caminhos).to_numpy()  # caminhos absolutos corretos
+dst_paths = (dest_path + os.sep + nomes).to_numpy()
+
+copied = 0
+failed = 0
+with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    futures = [(src, executor.submit(copiar_arquivo, src, dst)) for src, dst in zip(src_paths, dst_paths)]
+    for src, future in futures:
+        try:
+            future.result()
+            copied += 1
+        except FileNotFoundError:
+            print(f"Arquivo não encontrado: {src}")
+            missing += 1
+        except OSError as e:
+            print(f"Erro ao copiar {src}: {e}")
+            failed += 1
+
+print(
+    f"\n✅ Cópia concluída: {copied} copiadas, {missing} não encontradas, {failed} com erro "
+    f"(de {len(df_filtrado)} selecionadas)"
+)
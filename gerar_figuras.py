@@ -7,6 +7,7 @@ Cria imagens mostrando:
 """
 
 import os
+import functools
 import cv2
 import numpy as np
 from pathlib import Path
@@ -27,18 +28,28 @@ def criar_diretorio_figuras():
     os.makedirs(FIGURAS_DIR, exist_ok=True)
     logging.info(f"Diretório '{FIGURAS_DIR}' criado/verificado")
 
-def encontrar_imagem_exemplo(diretorio, extensoes=['.jpg', '.png', '.jpeg']):
-    """Encontra a primeira imagem válida em um diretório."""
+def encontrar_imagem_exemplo(diretorio, extensoes=('.jpg', '.png', '.jpeg')):
+    """Encontra a primeira imagem válida em um diretório (extensões em ordem de preferência)."""
     try:
         diretorio = Path(diretorio)
         if not diretorio.exists():
             logging.warning(f"Diretório não encontrado: {diretorio}")
             return None
         
-        for ext in extensoes:
-            imagens = list(diretorio.glob(f'*{ext}'))
-            if imagens:
-                return str(imagens[0])
+        # Uma única leitura do diretório; para assim que achar a extensão preferida
+        prioridade = {ext: i for i, ext in enumerate(extensoes)}
+        encontradas = {}
+        with os.scandir(diretorio) as it:
+            for entry in it:
+                i = prioridade.get(os.path.splitext(entry.name)[1].lower())
+                if i is None or i in encontradas or not entry.is_file():
+                    continue
+                if i == 0:
+                    return entry.path
+                encontradas[i] = entry.path
+        
+        if encontradas:
+            return encontradas[min(encontradas)]
         
         logging.warning(f"Nenhuma imagem encontrada em {diretorio}")
         return None
@@ -46,8 +57,9 @@ def encontrar_imagem_exemplo(diretorio, extensoes=['.jpg', '.png', '.jpeg']):
         logging.error(f"Erro ao procurar imagem em {diretorio}: {e}")
         return None
 
+@functools.lru_cache(maxsize=32)
 def carregar_e_redimensionar(caminho, tamanho=(512, 512)):
-    """Carrega e redimensiona uma imagem."""
+    """Carrega e redimensiona uma imagem (resultado em cache por caminho e tamanho)."""
     try:
         img = cv2.imread(caminho, cv2.IMREAD_GRAYSCALE)
         if img is None:
@@ -55,6 +67,7 @@ def carregar_e_redimensionar(caminho, tamanho=(512, 512)):
             return None
         
         img = cv2.resize(img, tamanho, interpolation=cv2.INTER_AREA)
+        img.setflags(write=False)  # a mesma instância é compartilhada pelo cache
         return img
     except Exception as e:
         logging.error(f"Erro ao processar {caminho}: {e}")
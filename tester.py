@@ -4,26 +4,32 @@ Sistema robusto de classificação de raios-X usando segmentação pulmonar e SS
 Processa imagens em batch, com logging detalhado e tratamento de erros.
 """
 
+from __future__ import annotations
+
 import argparse
+import atexit
+import json
 import logging
+import math
 import os
 import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict
+from typing import Iterator, List, Tuple, Optional, Dict
 
 import cv2
 import numpy as np
 import pandas as pd
-from skimage.metrics import structural_similarity as ssim
 from tqdm import tqdm
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
-# TensorFlow/Keras
+# TensorFlow/Keras são importados só quando necessários (ver carregar_modelo)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Reduz warnings do TF
-import tensorflow as tf
-from tensorflow import keras
+os.environ.setdefault('TF_GPU_ALLOCATOR', 'cuda_malloc_async')  # Evita fragmentar a memória da GPU
+tf = None
+keras = None
 
 # ========== CONFIGURAÇÃO ==========
 BASE_DIR = Path(__file__).parent.absolute()
@@ -32,203 +38,610 @@ OUTPUT_DIR = BASE_DIR / "output"
 SEG_SIZE = (256, 256)
 SSIM_SIZE = (224, 224)
 BATCH_SIZE = 16
+NUM_THREADS_LEITURA = min(8, os.cpu_count() or 1)  # Threads para ler/decodificar imagens
+PREFETCH_LEITURA = 2 * BATCH_SIZE  # Máximo de imagens lidas adiantadas
 MASK_THRESHOLD = 0.5
-SAVE_SEGMENTED = True  # Salvar imagens segmentadas
+SAVE_SEGMENTED_PNG = True   # Salvar cada imagem segmentada (para inspeção visual)
+SAVE_SEGMENTED_NPY = False  # Salvar a pasta inteira como um único .npy + lista de nomes
+NUM_THREADS_GRAVACAO = 4  # Threads para gravar as imagens segmentadas em segundo plano
+USAR_CACHE_REFERENCIAS = True  # Reaproveitar a segmentação das referências entre execuções
+CACHE_DIR = OUTPUT_DIR / "cache"
 
-# Configurar GPU (se disponível)
-gpus = tf.config.list_physical_devices('GPU')
-if gpus:
-    try:
-        for gpu in gpus:
-            tf.config.experimental.set_memory_growth(gpu, True)
-        logging.info(f"GPU disponível: {len(gpus)} dispositivo(s)")
-    except RuntimeError as e:
-        logging.warning(f"Erro ao configurar GPU: {e}")
+# SSIM (mesmos parâmetros padrão do skimage: janela uniforme 7x7, K1=0.01, K2=0.03)
+SSIM_WIN = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_DATA_RANGE = 255.0  # imagens em uint8
+SSIM_C1 = (SSIM_K1 * SSIM_DATA_RANGE) ** 2
+SSIM_C2 = (SSIM_K2 * SSIM_DATA_RANGE) ** 2
+SSIM_COV_NORM = SSIM_WIN ** 2 / (SSIM_WIN ** 2 - 1)  # covariância amostral
+USAR_SSIM_GPU = True  # Compara com todas as referências de uma vez na GPU (se disponível)
+SSIM_LOTE_GPU = 256   # Referências por chamada na GPU (limita memória)
+TF_THREADS_INTRA = 2  # Threads de CPU do TensorFlow por operação, só com GPU (libera a CPU)
+TF_THREADS_INTER = 1  # Operações do TensorFlow em paralelo na CPU, só com GPU
+NUM_THREADS_SSIM = os.cpu_count() or 1  # Imagens classificadas em paralelo (caminho CPU)
 
-# Configurar logging
+# Configurar logging (o arquivo tester.log é adicionado em main, depois de criar OUTPUT_DIR)
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(OUTPUT_DIR / 'tester.log' if OUTPUT_DIR.exists() else 'tester.log')
-    ]
+    format=LOG_FORMAT,
+    handlers=[logging.StreamHandler(sys.stdout)]
 )
 
-# Validar e carregar modelo
-if not MODEL_PATH.exists():
-    logging.error(f"❌ Modelo não encontrado: {MODEL_PATH}")
-    sys.exit(1)
+# Preenchidos por carregar_modelo
+gpus = []
+model_segment = None
+inferir_mascaras = None
+
+
+def carregar_modelo() -> None:
+    """
+    Importa o TensorFlow, configura a GPU e carrega o modelo de segmentação.
+    
+    Feito sob demanda para que importar o módulo (ou rodar --help) não pague o
+    custo do TensorFlow; chamado por main e por segmentar_pulmao_batch, para que
+    carregar_imagens funcione também com o módulo importado. Chamadas repetidas
+    não fazem nada.
+    """
+    global tf, keras, gpus, model_segment, inferir_mascaras
+    if model_segment is not None:
+        return
+    
+    import tensorflow as tf
+    from tensorflow import keras
+    
+    # Configurar GPU (se disponível)
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus:
+        # Com GPU o TensorFlow quase não usa a CPU: limita seus threads para não disputar
+        # núcleos com a leitura/gravação de imagens. Sem GPU a segmentação roda na CPU
+        # (antes e separada do SSIM) e fica com o padrão do TensorFlow. Precisa vir antes
+        # de qualquer operação, quando o runtime ainda não foi iniciado.
+        tf.config.threading.set_intra_op_parallelism_threads(TF_THREADS_INTRA)
+        tf.config.threading.set_inter_op_parallelism_threads(TF_THREADS_INTER)
+        try:
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+            logging.info(f"GPU disponível: {len(gpus)} dispositivo(s)")
+        except RuntimeError as e:
+            logging.warning(f"Erro ao configurar GPU: {e}")
+    
+    # Validar e carregar modelo
+    if not MODEL_PATH.exists():
+        logging.error(f"❌ Modelo não encontrado: {MODEL_PATH}")
+        sys.exit(1)
+    
+    try:
+        model_segment = keras.models.load_model(str(MODEL_PATH), compile=False)
+        logging.info(f"✅ Modelo carregado: {MODEL_PATH}")
+    except Exception as e:
+        logging.exception(f"❌ Falha ao carregar modelo: {e}")
+        sys.exit(1)
+    
+    @tf.function(input_signature=[tf.TensorSpec((None, SEG_SIZE[1], SEG_SIZE[0], 1), tf.float32)])
+    def _inferir(batch: tf.Tensor) -> tf.Tensor:
+        """Executa o modelo em grafo compilado (sem o overhead por chamada de model.predict)."""
+        return model_segment(batch, training=False)
+    
+    inferir_mascaras = _inferir
+
 
-try:
-    model_segment = keras.models.load_model(str(MODEL_PATH), compile=False)
-    logging.info(f"✅ Modelo carregado: {MODEL_PATH}")
-except Exception as e:
-    logging.exception(f"❌ Falha ao carregar modelo: {e}")
-    sys.exit(1)
+# Buffers de entrada do modelo, alocados uma única vez e reaproveitados a cada batch
+_seg_u8 = np.empty((BATCH_SIZE, SEG_SIZE[1], SEG_SIZE[0]), dtype=np.uint8)
+_seg_buf = np.empty((BATCH_SIZE, SEG_SIZE[1], SEG_SIZE[0], 1), dtype=np.float32)
 
 
-def segmentar_pulmao_batch(imagens_gray: List[np.ndarray]) -> List[np.ndarray]:
+def segmentar_pulmao_batch(imagens_gray: List[np.ndarray]) -> Tuple[np.ndarray, bool]:
     """
     Segmenta múltiplas imagens em batch para melhor performance.
     
     Args:
-        imagens_gray: Lista de imagens em escala de cinza
+        imagens_gray: Lista de imagens em escala de cinza (ou array (N, H, W) já empilhado)
         
     Returns:
-        Lista de imagens segmentadas
+        Tuple (array (N, H, W) uint8 com as imagens segmentadas, já em SSIM_SIZE,
+        True se todas foram segmentadas). Se a predição falhar, as imagens
+        restantes ficam zeradas e o segundo valor é False.
     """
-    if not imagens_gray:
-        return []
+    carregar_modelo()
+    segmentadas = np.zeros((len(imagens_gray), SSIM_SIZE[1], SSIM_SIZE[0]), dtype=np.uint8)
+    
+    # Predição em batches de tamanho fixo (o último é completado com zeros), para
+    # que o grafo e os kernels escolhidos sejam sempre os mesmos
+    for inicio in range(0, len(imagens_gray), BATCH_SIZE):
+        bloco = imagens_gray[inicio:inicio + BATCH_SIZE]
+        n = len(bloco)
+        
+        # Preenche os buffers reutilizados, sem montar listas nem empilhar cópias
+        for i, img in enumerate(bloco):
+            cv2.resize(img, SEG_SIZE, dst=_seg_u8[i], interpolation=cv2.INTER_AREA)
+            np.divide(_seg_u8[i], 255.0, out=_seg_buf[i, :, :, 0], dtype=np.float32)
+        _seg_buf[n:] = 0.0
+        
+        try:
+            masks = inferir_mascaras(tf.constant(_seg_buf)).numpy()[:n]
+        except Exception as e:
+            logging.error(f"Erro na predição batch: {e}")
+            return segmentadas, False
+        
+        # Aplica as máscaras no bloco inteiro de uma vez: (n, 256, 256)
+        batch_seg = np.where(masks[..., 0] > MASK_THRESHOLD, _seg_u8[:n], np.uint8(0))
+        
+        # Redimensiona uma única vez para o tamanho usado no SSIM
+        for i in range(n):
+            cv2.resize(batch_seg[i], SSIM_SIZE, dst=segmentadas[inicio + i], interpolation=cv2.INTER_AREA)
     
-    # Prepara batch
-    batch = []
-    for img in imagens_gray:
-        img_resized = cv2.resize(img, SEG_SIZE, interpolation=cv2.INTER_AREA)
-        img_norm = img_resized.astype(np.float32) / 255.0
-        batch.append(img_norm)
+    return segmentadas, True
+
+
+@dataclass(frozen=True)
+class EstatisticasSSIM:
+    """
+    Termos do SSIM que dependem de uma única imagem (mapas float32 em SSIM_SIZE).
     
-    batch_array = np.expand_dims(np.array(batch), axis=-1)  # (N, 256, 256, 1)
+    Os denominadores do SSIM são somas de um termo de cada imagem, então cada
+    imagem já guarda a sua metade da constante: (μ1² + C1/2) + (μ2² + C1/2) = μ1² + μ2² + C1.
+    """
+    img: np.ndarray         # imagem uint8
+    mu: np.ndarray          # μ
+    luminancia: np.ndarray  # μ² + C1/2
+    contraste: np.ndarray   # σ² + C2/2
+
+
+def precomputar_stats_ssim(img: np.ndarray) -> EstatisticasSSIM:
+    """
+    Pré-calcula os termos do SSIM que dependem de uma única imagem.
     
-    # Predição em batch
-    try:
-        masks = model_segment.predict(batch_array, batch_size=BATCH_SIZE, verbose=0)
-    except Exception as e:
-        logging.error(f"Erro na predição batch: {e}")
-        return [np.zeros_like(img) for img in imagens_gray]
+    Feito uma vez por imagem, deixa para cada par apenas o filtro do produto cruzado.
+    
+    Args:
+        img: Imagem segmentada (uint8, SSIM_SIZE)
+        
+    Returns:
+        EstatisticasSSIM da imagem
+    """
+    janela = (SSIM_WIN, SSIM_WIN)
+    
+    # Somas das janelas em inteiros de 32 bits direto do uint8; só o resultado vira float32
+    mu = cv2.boxFilter(img, cv2.CV_32F, janela)
+    mu_sq = mu * mu
+    sigma_sq = SSIM_COV_NORM * (cv2.sqrBoxFilter(img, cv2.CV_32F, janela) - mu_sq)
     
-    # Aplica máscaras
-    segmentadas = []
-    for i, (img, mask) in enumerate(zip(batch, masks)):
-        mask_bin = (mask[:, :, 0] > MASK_THRESHOLD).astype(np.uint8)
-        img_seg = (img * 255.0 * mask_bin).astype(np.uint8)
-        segmentadas.append(img_seg)
+    mu_sq += SSIM_C1 / 2
+    sigma_sq += SSIM_C2 / 2
+    return EstatisticasSSIM(img, mu, mu_sq, sigma_sq)
+
+
+_buffers_ssim = threading.local()
+
+
+def _buffers_ssim_par(shape: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Retorna buffers de trabalho da thread atual, realocando só se o shape mudar."""
+    buffers = getattr(_buffers_ssim, 'buffers', None)
+    if buffers is None or buffers[0].shape != shape:
+        buffers = tuple(np.empty(shape, dtype=np.float32) for _ in range(3))
+        buffers += (np.empty(shape, dtype=np.uint16),)
+        _buffers_ssim.buffers = buffers
+    return buffers
+
+
+def ssim_par(stats1: EstatisticasSSIM, stats2: EstatisticasSSIM) -> float:
+    """
+    Calcula o SSIM médio entre duas imagens a partir das estatísticas pré-calculadas.
+    
+    Equivale a structural_similarity(img1, img2, data_range=255) do skimage sobre as
+    imagens uint8. Todas as operações escrevem em buffers reutilizados, sem alocar
+    arrays por par.
+    
+    Args:
+        stats1, stats2: Saídas de precomputar_stats_ssim
+        
+    Returns:
+        Valor SSIM
+    """
+    num, den, tmp, produto = _buffers_ssim_par(stats1.img.shape)
+    
+    # Numerador: (2·μ12 + C1) · (2·σ12 + C2), com σ12 = cov_norm · (E[xy] - μ12)
+    # O produto de dois uint8 cabe exato em uint16 (metade dos bytes de um float32)
+    cv2.multiply(stats1.img, stats2.img, dst=produto, dtype=cv2.CV_16U)
+    cv2.boxFilter(produto, cv2.CV_32F, (SSIM_WIN, SSIM_WIN), dst=num)
+    np.multiply(stats1.mu, stats2.mu, out=tmp)
+    np.subtract(num, tmp, out=num)
+    num *= 2 * SSIM_COV_NORM
+    num += SSIM_C2
+    tmp *= 2
+    tmp += SSIM_C1
+    num *= tmp
+    
+    # Denominador: (μ1² + μ2² + C1) · (σ1² + σ2² + C2), constantes já embutidas nas estatísticas
+    np.add(stats1.luminancia, stats2.luminancia, out=den)
+    np.add(stats1.contraste, stats2.contraste, out=tmp)
+    den *= tmp
+    
+    num /= den
+    
+    # Descarta a borda em que a janela sai da imagem (como o skimage)
+    pad = (SSIM_WIN - 1) // 2
+    return float(num[pad:-pad, pad:-pad].mean(dtype=np.float64))
+
+
+def calcular_ssim_robusto(stats1: EstatisticasSSIM, stats2: EstatisticasSSIM) -> float:
+    """
+    Calcula SSIM com tratamento de erros.
     
-    return segmentadas
+    Args:
+        stats1, stats2: Estatísticas pré-calculadas das imagens a comparar
+        
+    Returns:
+        Valor SSIM ou NaN em caso de erro
+    """
+    try:
+        valor_ssim = ssim_par(stats1, stats2)
+        
+        if not math.isfinite(valor_ssim):
+            logging.warning("SSIM não finito detectado")
+            return math.nan
+            
+        return valor_ssim
+    except Exception as e:
+        logging.debug(f"Erro ao calcular SSIM: {e}")
+        return math.nan
 
 
-def segmentar_pulmao(imagem_gray: np.ndarray) -> np.ndarray:
+def somar_ssim(stats_img: EstatisticasSSIM, stats_refs: List[EstatisticasSSIM]) -> Tuple[float, int]:
     """
-    Segmenta os pulmões usando o modelo U-Net (versão single image).
+    Acumula o SSIM de uma imagem com várias referências, ignorando as comparações que falharam.
     
     Args:
-        imagem_gray: imagem numpy (escala de cinza)
+        stats_img: Estatísticas da imagem a classificar
+        stats_refs: Estatísticas das referências
         
     Returns:
-        imagem com apenas os pulmões (ou seja, com máscara aplicada)
+        Tuple (soma dos SSIM válidos, número de SSIM válidos)
     """
-    return segmentar_pulmao_batch([imagem_gray])[0]
+    soma = 0.0
+    n = 0
+    for ref in stats_refs:
+        val = calcular_ssim_robusto(stats_img, ref)
+        if not math.isnan(val):
+            soma += val
+            n += 1
+    return soma, n
+
+
+EstatisticasSSIMTF = Tuple['tf.Tensor', 'tf.Tensor', 'tf.Tensor', 'tf.Tensor']
+
+
+def _media_janela_tf(x: tf.Tensor) -> tf.Tensor:
+    """Média na janela SSIM_WIN x SSIM_WIN só onde a janela cabe inteira (= recorte do skimage)."""
+    return tf.nn.avg_pool2d(x, ksize=SSIM_WIN, strides=1, padding='VALID')
 
 
-def normalizar_para_ssim(img: np.ndarray, target_size: Tuple[int, int] = SSIM_SIZE) -> np.ndarray:
+def precomputar_stats_ssim_tf(imagens: np.ndarray) -> EstatisticasSSIMTF:
     """
-    Normaliza imagem para cálculo de SSIM consistente.
+    Versão em lote (TensorFlow) de precomputar_stats_ssim.
     
     Args:
-        img: Imagem de entrada
-        target_size: Tamanho alvo
+        imagens: Array (N, H, W) de imagens segmentadas (uint8, SSIM_SIZE)
         
     Returns:
-        Imagem normalizada em [0, 1]
+        Tuple de tensores (imagens, μ, μ², σ²), com shape (N, H, W, 1)
     """
-    img_resized = cv2.resize(img, target_size, interpolation=cv2.INTER_AREA)
-    img_float = img_resized.astype(np.float32)
+    batch = np.asarray(imagens)[..., np.newaxis]
+    x = tf.cast(tf.constant(batch), tf.float32)
     
-    if img_float.max() > 1.0:
-        img_float = img_float / 255.0
+    mu = _media_janela_tf(x)
+    mu_sq = mu * mu
+    sigma_sq = SSIM_COV_NORM * (_media_janela_tf(x * x) - mu_sq)
     
-    return np.clip(img_float, 0.0, 1.0)
+    return x, mu, mu_sq, sigma_sq
 
 
-def calcular_ssim_robusto(img1: np.ndarray, img2: np.ndarray) -> Optional[float]:
+def ssim_referencias_tf(stats_img: EstatisticasSSIMTF, stats_refs: EstatisticasSSIMTF) -> List[float]:
     """
-    Calcula SSIM com tratamento de erros.
+    Calcula o SSIM de uma imagem contra todas as referências em poucas chamadas na GPU.
+    
+    Args:
+        stats_img: Estatísticas de uma única imagem (batch de tamanho 1)
+        stats_refs: Estatísticas do conjunto de referências
+        
+    Returns:
+        Lista com os valores SSIM finitos
+    """
+    img, mu1, mu1_sq, sigma1_sq = stats_img
+    refs, mu2_todos, mu2_sq_todos, sigma2_sq_todos = stats_refs
+    
+    valores = []
+    for i in range(0, int(refs.shape[0]), SSIM_LOTE_GPU):
+        lote = slice(i, i + SSIM_LOTE_GPU)
+        mu2, mu2_sq, sigma2_sq = mu2_todos[lote], mu2_sq_todos[lote], sigma2_sq_todos[lote]
+        
+        mu12 = mu1 * mu2
+        sigma12 = SSIM_COV_NORM * (_media_janela_tf(img * refs[lote]) - mu12)
+        ssim_map = ((2 * mu12 + SSIM_C1) * (2 * sigma12 + SSIM_C2)) / (
+            (mu1_sq + mu2_sq + SSIM_C1) * (sigma1_sq + sigma2_sq + SSIM_C2)
+        )
+        valores.append(tf.reduce_mean(ssim_map, axis=[1, 2, 3]).numpy())
+    
+    valores = np.concatenate(valores).astype(np.float64)
+    return valores[np.isfinite(valores)].tolist()
+
+
+def ler_imagem(arquivo: Path) -> Optional[np.ndarray]:
+    """
+    Lê uma imagem em escala de cinza já redimensionada para SEG_SIZE.
     
     Args:
-        img1, img2: Imagens para comparar
+        arquivo: Caminho da imagem
         
     Returns:
-        Valor SSIM ou None em caso de erro
+        Imagem uint8 ou None se a leitura falhar
     """
     try:
-        img1_norm = normalizar_para_ssim(img1)
-        img2_norm = normalizar_para_ssim(img2)
+        img = cv2.imread(str(arquivo), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            logging.warning(f"⚠️ Falha ao ler: {arquivo.name}")
+            return None
+        return cv2.resize(img, SEG_SIZE, interpolation=cv2.INTER_AREA)
+    except Exception as e:
+        logging.error(f"❌ Erro ao processar {arquivo.name}: {e}")
+        return None
+
+
+def ler_imagens_em_paralelo(arquivos: List[Path]) -> Iterator[Tuple[Path, Optional[np.ndarray]]]:
+    """
+    Lê imagens em threads (cv2 libera o GIL), com no máximo PREFETCH_LEITURA leituras adiantadas.
+    
+    Args:
+        arquivos: Arquivos a ler
         
-        valor_ssim = ssim(img1_norm, img2_norm, data_range=1.0)
+    Yields:
+        Tuple (arquivo, imagem ou None), na ordem de entrada
+    """
+    with ThreadPoolExecutor(max_workers=NUM_THREADS_LEITURA) as pool:
+        pendentes = deque()
+        for arquivo in arquivos:
+            pendentes.append((arquivo, pool.submit(ler_imagem, arquivo)))
+            if len(pendentes) >= PREFETCH_LEITURA:
+                arquivo_pronto, futuro = pendentes.popleft()
+                yield arquivo_pronto, futuro.result()
         
-        if not np.isfinite(valor_ssim):
-            logging.warning("SSIM não finito detectado")
+        while pendentes:
+            arquivo_pronto, futuro = pendentes.popleft()
+            yield arquivo_pronto, futuro.result()
+
+
+def assinatura_segmentacao(arquivos: List[Path]) -> Dict:
+    """
+    Identifica os arquivos de uma pasta e a configuração que afeta a segmentação.
+    
+    Args:
+        arquivos: Arquivos de imagem da pasta
+        
+    Returns:
+        Dicionário serializável em JSON (nome, mtime e tamanho de cada arquivo + parâmetros)
+    """
+    estados = [(f.name, f.stat()) for f in arquivos]
+    return {
+        'arquivos': [[nome, st.st_mtime_ns, st.st_size] for nome, st in estados],
+        'modelo': MODEL_PATH.stat().st_mtime_ns,
+        'seg_size': list(SEG_SIZE),
+        'ssim_size': list(SSIM_SIZE),
+        'mask_threshold': MASK_THRESHOLD,
+    }
+
+
+def ler_cache_segmentacao(pasta: Path, assinatura: Dict) -> Optional[Tuple[np.ndarray, List[str]]]:
+    """
+    Lê a segmentação em cache de uma pasta, se ainda corresponder aos arquivos atuais.
+    
+    Args:
+        pasta: Pasta de imagens
+        assinatura: Saída de assinatura_segmentacao para a pasta
+        
+    Returns:
+        Tuple (array (N, H, W) de imagens segmentadas, nomes) ou None se o cache não
+        existir ou estiver desatualizado
+    """
+    cache_npy = CACHE_DIR / f"{pasta.name}.npy"
+    cache_meta = CACHE_DIR / f"{pasta.name}.json"
+    if not cache_npy.exists() or not cache_meta.exists():
+        return None
+    
+    try:
+        with open(cache_meta, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('assinatura') != assinatura:
             return None
-            
-        return float(valor_ssim)
+        
+        return np.load(cache_npy, mmap_mode='r'), meta['nomes']
     except Exception as e:
-        logging.debug(f"Erro ao calcular SSIM: {e}")
+        logging.warning(f"⚠️ Cache inválido para {pasta.name}: {e}")
         return None
 
 
-def carregar_imagens(pasta: Path, usar_batch: bool = True) -> Tuple[List[np.ndarray], List[str]]:
+def salvar_cache_segmentacao(pasta: Path, assinatura: Dict, segmentadas: np.ndarray, nomes: List[str]) -> None:
+    """
+    Salva a segmentação de uma pasta como um único .npy + metadados JSON.
+    
+    Args:
+        pasta: Pasta de imagens
+        assinatura: Saída de assinatura_segmentacao para a pasta
+        segmentadas: Array (N, H, W) de imagens segmentadas
+        nomes: Nomes correspondentes
+    """
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        np.save(CACHE_DIR / f"{pasta.name}.npy", segmentadas)
+        with open(CACHE_DIR / f"{pasta.name}.json", 'w', encoding='utf-8') as f:
+            json.dump({'assinatura': assinatura, 'nomes': nomes}, f)
+    except Exception as e:
+        logging.warning(f"⚠️ Falha ao salvar cache de {pasta.name}: {e}")
+
+
+# Gravação das imagens segmentadas em segundo plano (cv2.imwrite libera o GIL)
+_pool_gravacao = ThreadPoolExecutor(max_workers=NUM_THREADS_GRAVACAO)
+_gravacoes_pendentes: List[Tuple[Path, Future]] = []
+
+
+def gravar_em_segundo_plano(caminho: Path, img: np.ndarray) -> None:
+    """
+    Agenda a gravação de uma imagem sem bloquear o processamento.
+    
+    Args:
+        caminho: Arquivo de destino
+        img: Imagem a gravar (não deve ser modificada até a gravação terminar)
+    """
+    _gravacoes_pendentes.append((caminho, _pool_gravacao.submit(cv2.imwrite, str(caminho), img)))
+
+
+def aguardar_gravacoes() -> None:
+    """Espera as gravações pendentes terminarem e registra as que falharam."""
+    falhas = 0
+    while _gravacoes_pendentes:
+        caminho, futuro = _gravacoes_pendentes.pop()
+        try:
+            ok = futuro.result()
+        except Exception as e:
+            logging.warning(f"⚠️ Erro ao gravar {caminho}: {e}")
+            ok = False
+        if not ok:
+            falhas += 1
+    
+    if falhas:
+        logging.warning(f"⚠️ {falhas} imagem(ns) segmentada(s) não puderam ser gravadas")
+
+
+atexit.register(aguardar_gravacoes)
+
+
+def salvar_segmentadas(
+    pasta: Path,
+    segmentadas: np.ndarray,
+    nomes: List[str],
+    mtime_cache: Optional[int] = None
+) -> None:
+    """
+    Salva as imagens segmentadas de uma pasta, conforme SAVE_SEGMENTED_NPY/SAVE_SEGMENTED_PNG.
+    
+    Args:
+        pasta: Pasta de imagens de origem
+        segmentadas: Array (N, H, W) de imagens segmentadas
+        nomes: Nomes correspondentes
+        mtime_cache: mtime (ns) do cache de onde vieram as imagens, se vieram do cache;
+            imagens PNG gravadas depois dele já estão atualizadas e não são regravadas
+    """
+    if SAVE_SEGMENTED_NPY:
+        # Sempre regravado: é uma única escrita sequencial
+        seg_npy = OUTPUT_DIR / f"segmented_{pasta.name}.npy"
+        seg_txt = OUTPUT_DIR / f"segmented_{pasta.name}.txt"
+        try:
+            np.save(seg_npy, segmentadas)
+            seg_txt.write_text("\n".join(nomes) + "\n", encoding='utf-8')
+        except Exception as e:
+            logging.warning(f"⚠️ Não foi possível salvar {seg_npy.name}: {e}")
+    
+    if SAVE_SEGMENTED_PNG:
+        seg_dir = OUTPUT_DIR / f"segmented_{pasta.name}"
+        seg_dir.mkdir(parents=True, exist_ok=True)
+        atualizadas = set()
+        if mtime_cache is not None:
+            with os.scandir(seg_dir) as it:
+                atualizadas = {e.name for e in it if e.stat().st_mtime_ns >= mtime_cache}
+        
+        for i, nome in enumerate(nomes):
+            if nome not in atualizadas:
+                gravar_em_segundo_plano(seg_dir / nome, segmentadas[i])
+
+
+def carregar_imagens(
+    pasta: Path,
+    usar_batch: bool = True,
+    usar_cache: bool = False
+) -> Tuple[np.ndarray, List[str]]:
     """
     Carrega e segmenta imagens de uma pasta com processamento otimizado.
     
     Args:
         pasta: Path da pasta com imagens
         usar_batch: Se True, usa segmentação em batch
+        usar_cache: Se True, reaproveita/salva a segmentação em CACHE_DIR
         
     Returns:
-        Tuple (lista de imagens segmentadas, lista de nomes)
+        Tuple (array (N, H, W) uint8 de imagens segmentadas, lista de nomes)
     """
+    vazio = np.empty((0, SSIM_SIZE[1], SSIM_SIZE[0]), dtype=np.uint8)
+    
     if not pasta.exists():
         logging.error(f"❌ Pasta não encontrada: {pasta}")
-        return [], []
+        return vazio, []
     
-    # Lista arquivos de imagem
+    # Lista arquivos de imagem em ordem de inode (próxima da ordem no disco, melhora o
+    # readahead); no Linux o inode já vem do scandir, sem um stat por arquivo
     extensoes = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
-    arquivos = [f for f in pasta.iterdir() if f.suffix.lower() in extensoes]
+    with os.scandir(pasta) as it:
+        entradas = [
+            e for e in it
+            if os.path.splitext(e.name)[1].lower() in extensoes and e.is_file()
+        ]
+    entradas.sort(key=lambda e: e.inode())
+    arquivos = [Path(e.path) for e in entradas]
     
     if not arquivos:
         logging.warning(f"⚠️ Nenhuma imagem encontrada em {pasta}")
-        return [], []
+        return vazio, []
+    
+    if usar_cache:
+        assinatura = assinatura_segmentacao(arquivos)
+        em_cache = ler_cache_segmentacao(pasta, assinatura)
+        if em_cache is not None:
+            logging.info(f"♻️ Usando segmentação em cache de {pasta.name} ({len(em_cache[1])} imagens)")
+            mtime_cache = (CACHE_DIR / f"{pasta.name}.npy").stat().st_mtime_ns
+            salvar_segmentadas(pasta, *em_cache, mtime_cache=mtime_cache)
+            return em_cache
     
     logging.info(f"📂 Carregando {len(arquivos)} imagens de {pasta.name}")
     
-    # Carrega imagens em escala de cinza
-    imagens_gray = []
+    # Leitura em threads sobreposta à segmentação: enquanto um batch está no
+    # modelo, os próximos arquivos já estão sendo decodificados
+    tamanho_batch = BATCH_SIZE if usar_batch else 1
+    segmentadas = np.empty((len(arquivos), SSIM_SIZE[1], SSIM_SIZE[0]), dtype=np.uint8)
+    total = 0
     nomes = []
+    batch = []
+    falhou = False
     
-    for arquivo in tqdm(arquivos, desc=f"Lendo {pasta.name}", unit="img"):
-        try:
-            img = cv2.imread(str(arquivo), cv2.IMREAD_GRAYSCALE)
-            if img is None:
-                logging.warning(f"⚠️ Falha ao ler: {arquivo.name}")
-                continue
-            
-            imagens_gray.append(img)
-            nomes.append(arquivo.name)
-        except Exception as e:
-            logging.error(f"❌ Erro ao processar {arquivo.name}: {e}")
-    
-    if not imagens_gray:
-        return [], []
-    
-    # Segmenta em batch ou individualmente
-    logging.info(f"🔬 Segmentando {len(imagens_gray)} imagens...")
-    
-    if usar_batch:
-        segmentadas = []
-        for i in tqdm(range(0, len(imagens_gray), BATCH_SIZE), desc="Segmentando", unit="batch"):
-            batch = imagens_gray[i:i+BATCH_SIZE]
-            seg_batch = segmentar_pulmao_batch(batch)
-            segmentadas.extend(seg_batch)
-    else:
-        segmentadas = [segmentar_pulmao(img) for img in tqdm(imagens_gray, desc="Segmentando")]
-    
-    # Salva imagens segmentadas (opcional)
-    if SAVE_SEGMENTED:
-        seg_dir = OUTPUT_DIR / f"segmented_{pasta.name}"
-        seg_dir.mkdir(parents=True, exist_ok=True)
+    leituras = ler_imagens_em_paralelo(arquivos)
+    for arquivo, img in tqdm(leituras, total=len(arquivos), desc=f"Segmentando {pasta.name}", unit="img"):
+        if img is None:
+            continue
         
-        for nome, img_seg in zip(nomes, segmentadas):
-            cv2.imwrite(str(seg_dir / nome), img_seg)
+        batch.append(img)
+        nomes.append(arquivo.name)
+        if len(batch) == tamanho_batch:
+            segmentadas[total:total + len(batch)], ok = segmentar_pulmao_batch(batch)
+            falhou |= not ok
+            total += len(batch)
+            batch = []
+    
+    if batch:
+        segmentadas[total:total + len(batch)], ok = segmentar_pulmao_batch(batch)
+        falhou |= not ok
+        total += len(batch)
+    
+    if total == 0:
+        return vazio, []
+    segmentadas = segmentadas[:total]
+    
+    # Imagens zeradas por falha na predição não podem ir para o cache: a assinatura
+    # não mudaria e todas as execuções seguintes usariam as referências em branco
+    if falhou:
+        logging.warning(f"⚠️ Segmentação de {pasta.name} incompleta (imagens zeradas); cache não salvo")
+    elif usar_cache:
+        salvar_cache_segmentacao(pasta, assinatura, segmentadas, nomes)
+    
+    salvar_segmentadas(pasta, segmentadas, nomes)
     
     return segmentadas, nomes
 
@@ -239,102 +652,140 @@ pasta_doentes = BASE_DIR / 'valid_Doentes_frontal'
 pasta_desconhecidos = BASE_DIR / 'valid_desconhecidos_frontal'
 
 
+def classificar_imagem(
+    img: np.ndarray,
+    nome: str,
+    stats_saudaveis,
+    stats_doentes,
+    usar_gpu: bool
+) -> Dict:
+    """
+    Classifica uma imagem pelo SSIM médio com cada conjunto de referências.
+    
+    Args:
+        img: Imagem segmentada (H, W) a classificar
+        nome: Nome da imagem
+        stats_saudaveis, stats_doentes: Estatísticas pré-calculadas das referências
+            (listas na CPU, tensores na GPU ou None se o conjunto estiver vazio)
+        usar_gpu: Se True, usa o caminho em lote do TensorFlow
+        
+    Returns:
+        Dicionário com o resultado
+    """
+    try:
+        if usar_gpu:
+            stats_desconhecida = precomputar_stats_ssim_tf(img[np.newaxis])
+            ssim_saudaveis = (
+                ssim_referencias_tf(stats_desconhecida, stats_saudaveis)
+                if stats_saudaveis is not None else []
+            )
+            ssim_doentes = (
+                ssim_referencias_tf(stats_desconhecida, stats_doentes)
+                if stats_doentes is not None else []
+            )
+            soma_s, n_s = sum(ssim_saudaveis), len(ssim_saudaveis)
+            soma_d, n_d = sum(ssim_doentes), len(ssim_doentes)
+        else:
+            stats_desconhecida = precomputar_stats_ssim(img)
+            soma_s, n_s = somar_ssim(stats_desconhecida, stats_saudaveis)
+            soma_d, n_d = somar_ssim(stats_desconhecida, stats_doentes)
+        
+        mean_saudavel = soma_s / n_s if n_s else float('nan')
+        mean_doente = soma_d / n_d if n_d else float('nan')
+        
+        # Classifica
+        if np.isnan(mean_saudavel) and np.isnan(mean_doente):
+            classe = "Indefinido"
+            confianca = 0.0
+        elif np.isnan(mean_doente):
+            classe = "Saudável"
+            confianca = mean_saudavel
+        elif np.isnan(mean_saudavel):
+            classe = "Doente"
+            confianca = mean_doente
+        else:
+            if mean_saudavel > mean_doente:
+                classe = "Saudável"
+                confianca = mean_saudavel - mean_doente
+            else:
+                classe = "Doente"
+                confianca = mean_doente - mean_saudavel
+        
+        logging.info(
+            f"{nome:30s} | SSIM saudável: {mean_saudavel:.4f} | "
+            f"SSIM doente: {mean_doente:.4f} | {classe}"
+        )
+        
+        return {
+            'imagem': nome,
+            'ssim_medio_saudaveis': mean_saudavel,
+            'ssim_medio_doentes': mean_doente,
+            'classificacao': classe,
+            'confianca': confianca,
+            'n_comparacoes_saudavel': n_s,
+            'n_comparacoes_doente': n_d
+        }
+        
+    except Exception as e:
+        logging.exception(f"❌ Erro classificando {nome}: {e}")
+        return {
+            'imagem': nome,
+            'ssim_medio_saudaveis': None,
+            'ssim_medio_doentes': None,
+            'classificacao': 'Erro',
+            'confianca': 0.0,
+            'n_comparacoes_saudavel': 0,
+            'n_comparacoes_doente': 0
+        }
+
+
 def classificar_imagens(
-    imgs_desconhecidos: List[np.ndarray],
+    imgs_desconhecidos: np.ndarray,
     nomes_desconhecidos: List[str],
-    imgs_saudaveis: List[np.ndarray],
-    imgs_doentes: List[np.ndarray]
+    imgs_saudaveis: np.ndarray,
+    imgs_doentes: np.ndarray
 ) -> List[Dict]:
     """
     Classifica imagens desconhecidas usando SSIM médio.
     
+    Na CPU as imagens são classificadas em NUM_THREADS_SSIM threads (o OpenCV e as
+    operações NumPy em arrays grandes liberam o GIL, e os buffers do SSIM são por thread).
+    
     Args:
-        imgs_desconhecidos: Imagens a classificar
+        imgs_desconhecidos: Array (N, H, W) de imagens a classificar
         nomes_desconhecidos: Nomes das imagens
-        imgs_saudaveis: Imagens de referência saudáveis
-        imgs_doentes: Imagens de referência doentes
+        imgs_saudaveis: Array (R, H, W) de referências saudáveis
+        imgs_doentes: Array (R, H, W) de referências doentes
         
     Returns:
-        Lista de dicionários com resultados
+        Lista de dicionários com resultados, na ordem de imgs_desconhecidos
     """
-    resultados = []
-    
-    if not imgs_saudaveis and not imgs_doentes:
+    if len(imgs_saudaveis) == 0 and len(imgs_doentes) == 0:
         logging.error("❌ Nenhuma imagem de referência disponível")
-        return resultados
+        return []
+    
+    # Termos do SSIM das referências calculados uma única vez
+    usar_gpu = USAR_SSIM_GPU and bool(gpus)
+    if usar_gpu:
+        logging.info("⚡ SSIM em lote na GPU")
+        stats_saudaveis = precomputar_stats_ssim_tf(imgs_saudaveis) if len(imgs_saudaveis) else None
+        stats_doentes = precomputar_stats_ssim_tf(imgs_doentes) if len(imgs_doentes) else None
+    else:
+        stats_saudaveis = [precomputar_stats_ssim(img) for img in imgs_saudaveis]
+        stats_doentes = [precomputar_stats_ssim(img) for img in imgs_doentes]
     
-    logging.info(f"🔍 Classificando {len(imgs_desconhecidos)} imagens...")
+    n = imgs_desconhecidos.shape[0]
+    logging.info(f"🔍 Classificando {n} imagens...")
     
-    for idx, img_desconhecida in enumerate(tqdm(imgs_desconhecidos, desc="Classificando", unit="img")):
+    def classificar_indice(idx: int) -> Dict:
         nome = nomes_desconhecidos[idx] if idx < len(nomes_desconhecidos) else f"img_{idx}"
-        
-        try:
-            # Calcula SSIM com saudáveis
-            ssim_saudaveis = []
-            if imgs_saudaveis:
-                for ref in imgs_saudaveis:
-                    val = calcular_ssim_robusto(img_desconhecida, ref)
-                    if val is not None:
-                        ssim_saudaveis.append(val)
-            
-            mean_saudavel = np.nanmean(ssim_saudaveis) if ssim_saudaveis else float('nan')
-            
-            # Calcula SSIM com doentes
-            ssim_doentes = []
-            if imgs_doentes:
-                for ref in imgs_doentes:
-                    val = calcular_ssim_robusto(img_desconhecida, ref)
-                    if val is not None:
-                        ssim_doentes.append(val)
-            
-            mean_doente = np.nanmean(ssim_doentes) if ssim_doentes else float('nan')
-            
-            # Classifica
-            if np.isnan(mean_saudavel) and np.isnan(mean_doente):
-                classe = "Indefinido"
-                confianca = 0.0
-            elif np.isnan(mean_doente):
-                classe = "Saudável"
-                confianca = mean_saudavel
-            elif np.isnan(mean_saudavel):
-                classe = "Doente"
-                confianca = mean_doente
-            else:
-                if mean_saudavel > mean_doente:
-                    classe = "Saudável"
-                    confianca = mean_saudavel - mean_doente
-                else:
-                    classe = "Doente"
-                    confianca = mean_doente - mean_saudavel
-            
-            resultados.append({
-                'imagem': nome,
-                'ssim_medio_saudaveis': mean_saudavel,
-                'ssim_medio_doentes': mean_doente,
-                'classificacao': classe,
-                'confianca': confianca,
-                'n_comparacoes_saudavel': len(ssim_saudaveis),
-                'n_comparacoes_doente': len(ssim_doentes)
-            })
-            
-            logging.info(
-                f"{nome:30s} | SSIM saudável: {mean_saudavel:.4f} | "
-                f"SSIM doente: {mean_doente:.4f} | {classe}"
-            )
-            
-        except Exception as e:
-            logging.exception(f"❌ Erro classificando {nome}: {e}")
-            resultados.append({
-                'imagem': nome,
-                'ssim_medio_saudaveis': None,
-                'ssim_medio_doentes': None,
-                'classificacao': 'Erro',
-                'confianca': 0.0,
-                'n_comparacoes_saudavel': 0,
-                'n_comparacoes_doente': 0
-            })
+        return classificar_imagem(imgs_desconhecidos[idx], nome, stats_saudaveis, stats_doentes, usar_gpu)
+    
+    if usar_gpu or NUM_THREADS_SSIM <= 1:
+        return [classificar_indice(idx) for idx in tqdm(range(n), desc="Classificando", unit="img")]
     
-    return resultados
+    with ThreadPoolExecutor(max_workers=NUM_THREADS_SSIM) as pool:
+        return list(tqdm(pool.map(classificar_indice, range(n)), total=n, desc="Classificando", unit="img"))
 
 
 def gerar_estatisticas(resultados: List[Dict]) -> Dict:
@@ -359,24 +810,38 @@ def gerar_estatisticas(resultados: List[Dict]) -> Dict:
 
 def main():
     """Função principal."""
+    argparse.ArgumentParser(description=__doc__).parse_args()
+    
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    log_arquivo = logging.FileHandler(OUTPUT_DIR / 'tester.log')
+    log_arquivo.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.getLogger().addHandler(log_arquivo)
+    
+    carregar_modelo()
+    
+    # Kernels SIMD do OpenCV ligados; uma thread interna por chamada, já que o
+    # paralelismo vem das threads de leitura e de classificação
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(1)
+    if not cv2.useOptimized():
+        logging.warning("⚠️ OpenCV sem otimizações SIMD; o SSIM na CPU será mais lento")
     
     logging.info("=" * 80)
     logging.info("🏥 Sistema de Classificação de Raios-X - Iniciando")
     logging.info("=" * 80)
     
     # Carrega conjuntos de referência
-    imgs_saudaveis, _ = carregar_imagens(pasta_saudaveis)
-    imgs_doentes, _ = carregar_imagens(pasta_doentes)
+    imgs_saudaveis, _ = carregar_imagens(pasta_saudaveis, usar_cache=USAR_CACHE_REFERENCIAS)
+    imgs_doentes, _ = carregar_imagens(pasta_doentes, usar_cache=USAR_CACHE_REFERENCIAS)
     
-    if not imgs_saudaveis and not imgs_doentes:
+    if len(imgs_saudaveis) == 0 and len(imgs_doentes) == 0:
         logging.error("❌ Nenhuma imagem de referência carregada. Abortando.")
         return
     
     # Carrega desconhecidos
     imgs_desconhecidos, nomes_desconhecidos = carregar_imagens(pasta_desconhecidos)
     
-    if not imgs_desconhecidos:
+    if len(imgs_desconhecidos) == 0:
         logging.error("❌ Nenhuma imagem desconhecida para classificar. Abortando.")
         return
     
@@ -402,6 +867,8 @@ def main():
     for key, value in stats.items():
         logging.info(f"{key:30s}: {value}")
     logging.info("=" * 80)
+    
+    aguardar_gravacoes()
     logging.info("✅ Processamento concluído com sucesso!")
 
 